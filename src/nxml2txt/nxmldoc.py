@@ -1,22 +1,121 @@
-from bs4 import BeautifulSoup, Tag
+import bisect
+
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import dataclasses
 import html
 from lxml import etree
-from lxml.etree import ElementTree
 from nxml2txt import rewritetex
 from nxml2txt import rewritemmla
 from nxml2txt import rewriteu2a
 from nxml2txt import standoff
+import numpy as np
 import os
 import pandas as pd
 import re
 import requests
 import sys
+import threading
 
 TexOptions = namedtuple("TexOptions", "verbose")
 U2aOptions = namedtuple("U2aOptions", "hex keep_missing stdout directory overwrite")
 
+# consecutive whitespace, for per-paragraph normalization
+_WS_RE = re.compile(r"\s+")
+
+# sentinel for "not found yet" where None is a legitimate value
+_UNSET = object()
+
+# an entity reference (named or numeric, optionally missing its ';' the
+# way html.unescape tolerates) or a bare ampersand
+_ENTITY_OR_AMP_RE = re.compile(
+    r"&(?:[A-Za-z][A-Za-z0-9]*;?|#[0-9]+;?|#[xX][0-9A-Fa-f]+;?)|&"
+)
+
+# anything the entity cleanup would actually rewrite: an ampersand not
+# already part of an XML-safe reference, or a '<' that can't open a
+# tag, comment, PI or end tag. Clean JATS has neither, and the cleanup
+# is a no-op on the five predefined entities and numeric references,
+# so a miss here means the pass can be skipped altogether.
+_NEEDS_FIXUP_RE = re.compile(
+    r"&(?!(?:amp|lt|gt|quot|apos|#\d+|#x[0-9a-fA-F]+);)|<(?![/?!A-Za-z])"
+)
+
+
+def _decode_entity(m):
+    """Decodes a single entity reference for NxmlDoc's XML cleanup,
+    re-escaping any XML-significant character it produces and escaping
+    the ampersand of anything html.unescape doesn't recognize."""
+    s = html.unescape(m.group())
+    if s == "&":
+        # a bare ampersand, or &amp; itself
+        return "&amp;"
+    if s == "<":
+        return "&lt;"
+    if s.startswith("&"):
+        # unrecognized entity: only its ampersand needs escaping
+        return "&amp;" + m.group()[1:]
+    return s
+
+# per-tag field handlers for reference extraction; each takes the
+# element's text content and the ref dict under construction, so the
+# walk over a <ref>'s descendants is a single dict lookup per element
+# rather than a long tag-comparison chain
+
+
+def _ref_surname(text, ref_dict):
+    text = text.replace("'", "''")
+    if ref_dict.get("first_author", None) is None:
+        ref_dict["first_author"] = text
+    # the first surname also seeds second_author, and each later one
+    # overwrites it (kept as the original comparison chain behaved)
+    ref_dict["second_author"] = text
+    ref_dict["author"] += text
+
+
+def _ref_name(text, ref_dict):
+    if len(ref_dict["author"]) > 0:
+        ref_dict["author"] += ", "
+
+
+def _ref_given_names(text, ref_dict):
+    ref_dict["author"] += " " + text.replace("'", "''")
+
+
+def _ref_article_title(text, ref_dict):
+    ref_dict["title"] = text.replace("'", "''")
+
+
+def _ref_source(text, ref_dict):
+    ref_dict["journal"] = text
+
+
+def _ref_year(text, ref_dict):
+    m = re.match("(\\d\\d\\d\\d)", text)
+    if m:
+        ref_dict["year"] = m.group(1)
+
+
+def _ref_volume(text, ref_dict):
+    ref_dict["vol"] = text
+
+
+def _ref_fpage(text, ref_dict):
+    ref_dict["page"] = text
+
+
+_REF_FIELD_HANDLERS = {
+    "surname": _ref_surname,
+    "name": _ref_name,
+    "given-names": _ref_given_names,
+    "article-title": _ref_article_title,
+    "source": _ref_source,
+    "year": _ref_year,
+    "volume": _ref_volume,
+    "fpage": _ref_fpage,
+}
+
+
 @dataclasses.dataclass
 class NxmlDoc:
     """A class that provides structure for full text papers specified under the JATS 'nxml' format.
@@ -78,15 +177,23 @@ class NxmlDoc:
 
         # HTML entities kill the XML parse
         # but any '<' characters must be replaced with &lt; in XML (and '& with &amp;)
-        xml = xml.replace("<", "__less_than__")
-        xml = html.unescape(xml)
-        xml = xml.replace("&", "&amp;")
-        xml = xml.replace("<", "&lt;")
-        xml = xml.replace("__less_than__", "<")
+        # one streamed regex pass decodes entities and re-escapes what
+        # they produce, instead of five full-document replace scans;
+        # well-formed input (the common case for JATS feeds) skips the
+        # rewrite entirely after one search
+        if _NEEDS_FIXUP_RE.search(xml) is not None:
+            xml = _ENTITY_OR_AMP_RE.sub(_decode_entity, xml)
         xml = xml.encode("utf-8")
         self.xml = xml
 
-        tree = ElementTree(etree.fromstring(xml))
+        # skip xml:id collection (nothing here looks ids up through the
+        # parser) and lift the parser's tree-depth/text-length guards
+        # for large full-text documents; getroottree() reuses the tree
+        # the parse already built instead of wrapping the root again
+        parser = etree.XMLParser(huge_tree=True, collect_ids=False)
+        root = etree.fromstring(xml, parser)
+        tree = root.getroottree()
+        self._root = root
         tex_options = TexOptions(verbose=True)
         rewritetex.process_tree(tree, options=tex_options)
 
@@ -107,6 +214,60 @@ class NxmlDoc:
         self.text = text
         self.standoffs = standoffs
 
+        # keep the processed tree around so that reference extraction
+        # can walk it directly instead of re-parsing self.xml
+        self._tree = tree
+
+        # Standoffs sorted by start offset, with the starts mirrored in a
+        # plain list for binary searching. Computed once here so that the
+        # per-standoff helpers don't re-sort the whole list on every call.
+        # (Ends are read live from the standoff objects because the
+        # dataframe builders clip overlapping ends in place.)
+        self._standoffs_by_start = sorted(standoffs, key=lambda x: x.start)
+        self._starts = [s.start for s in self._standoffs_by_start]
+
+        # Structure-of-arrays mirror of the sorted standoffs for the
+        # containment scan: contiguous int32 start/end arrays vectorize
+        # the "end > pos" test instead of touching one Python object per
+        # candidate. _so_index maps standoff identity to its array slot
+        # so that _tile_text_standoffs can keep _np_ends in sync when it
+        # clips ends in place.
+        n = len(self._standoffs_by_start)
+        self._np_starts = np.fromiter(self._starts, dtype=np.int32, count=n)
+        self._np_ends = np.fromiter(
+            (s.end for s in self._standoffs_by_start), dtype=np.int32, count=n
+        )
+        self._np_objs = np.array(self._standoffs_by_start, dtype=object)
+        self._so_index = {id(s): i for i, s in enumerate(self._standoffs_by_start)}
+
+        # Standoffs bucketed by tag in document order, with any
+        # "{namespace}" prefix stripped, plus a per-standoff local-tag
+        # lookup. One pass here replaces the repeated tag filtering
+        # (and per-standoff namespace regexes) in the section helpers
+        # and dataframe builders, and makes tag lookups behave the same
+        # for namespaced and namespace-free JATS.
+        self._by_tag = {}
+        self._local_tag = {}
+        for s in standoffs:
+            tag = s.element.tag.rsplit("}", 1)[-1]
+            self._local_tag[id(s)] = tag
+            self._by_tag.setdefault(tag, []).append(s)
+
+        # Cached <title> child element and sec-type attribute for every
+        # <sec> standoff. find() walks the children on each call and the
+        # section helpers used to repeat it up to twice per sec per
+        # lookup; the wildcard-namespace find also resolves titles in
+        # documents that use a default JATS namespace.
+        self._sec_title_el = {}
+        self._sec_type = {}
+        for s in self._by_tag.get("sec", []):
+            self._sec_title_el[id(s)] = s.element.find("{*}title")
+            self._sec_type[id(s)] = s.element.get("sec-type", None)
+
+        # Per-standoff annotation cache for _context, keyed by standoff
+        # identity (the standoff objects live as long as the document).
+        self._context_cache = {}
+
         self.to_exclude = ["table-wrap-foot"]
         self.text_tag_types = [
             "front/article-title",
@@ -146,177 +307,203 @@ class NxmlDoc:
             'nlm': 'http://dtd.nlm.nih.gov/2.0/xsd/archivearticle'
         }
 
-    def get_figure_reference(self, t):
+    def _containing(self, t):
+        """Returns the standoffs whose [start, end) span contains the start
+        of standoff t (excluding t itself) in ascending start order.
+        searchsorted narrows the candidates to those starting at or
+        before t.start and the end test runs vectorized over the
+        contiguous _np_ends array rather than per Python object."""
         pos = t.start
-        hits = []
-        for s in sorted(self.standoffs, key=lambda x: x.start):
-            if pos >= s.start and pos < s.end and s != t:
-                hits.append(s)
-        for t in hits:
-            if t.element.tag == "fig":
-                return t.element.get("id", "")
-        return ""
-
-    def get_sec_tree(self, t):
-        pos = t.start
-        hits = []
-        for s in sorted(self.standoffs, key=lambda x: x.start):
-            if pos >= s.start and pos < s.end and s != t:
-                hits.append(s)
+        idx = int(np.searchsorted(self._np_starts, pos, side="right"))
+        hits = self._np_objs[:idx][self._np_ends[:idx] > pos]
+        return [s for s in hits if s is not t]
+
+    def _context(self, so):
+        """Returns (sec_tree, sec_title, top_sec_title, figure_reference)
+        for a standoff, computing all four once and caching the result
+        by standoff identity. The dataframe builders request all four
+        per text standoff, so without the cache the same containment
+        scan would run four times per row."""
+        cached = self._context_cache.get(id(so))
+        if cached is None:
+            cached = self._annotate(so)
+            self._context_cache[id(so)] = cached
+        return cached
+
+    def _annotate(self, so):
+        """Computes (sec_tree, sec_title, top_sec_title, fig_ref) for a
+        standoff in a single walk over its containing standoffs. The
+        four public getters each used to walk the same list separately;
+        fusing them keeps the work of one containment scan per row."""
         sec_tree = ""
-        for t in hits:
-            if t.element.tag == "sec":
+        last_sec = None
+        top_sec_title = _UNSET
+        fig_ref = ""
+        seen_fig = False
+        for s in self._containing(so):
+            tag = self._local_tag[id(s)]
+            if tag == "sec":
+                title = self._sec_title_el[id(s)]
                 if len(sec_tree) > 0:
                     sec_tree += " >> "
-                if (
-                    t.element.find("title") is not None
-                    and t.element.find("title").text is not None
-                ):
-                    sec_tree += t.element.find("title").text
+                if title is not None and title.text is not None:
+                    sec_tree += title.text
                 else:
                     sec_tree += " ??? "
-        return sec_tree
+                last_sec = s
+                # the top-level title comes from the outermost sec that
+                # has either a sec-type or a title element
+                if top_sec_title is _UNSET:
+                    if self._sec_type[id(s)]:
+                        top_sec_title = self._sec_type[id(s)]
+                    elif title is not None:
+                        top_sec_title = title.text
+            elif tag == "fig" and not seen_fig:
+                fig_ref = s.element.get("id", "")
+                seen_fig = True
+        if top_sec_title is _UNSET:
+            top_sec_title = ""
+        if last_sec is None:
+            sec_title = ""
+        else:
+            title = self._sec_title_el[id(last_sec)]
+            sec_title = title.text if title is not None else ""
+        return sec_tree, sec_title, top_sec_title, fig_ref
+
+    def get_figure_reference(self, t):
+        return self._annotate(t)[3]
+
+    def get_sec_tree(self, t):
+        return self._annotate(t)[0]
 
     def get_sec_tag(self, t):
-        pos = t.start
-        hits = []
-        for s in sorted(self.standoffs, key=lambda x: x.start):
-            if pos >= s.start and pos < s.end and s != t:
-                hits.append(s)
-        sec = None
-        for t in hits:
-            if t.element.tag == "sec":
-                sec = t
-        if sec is None:
-            return ""
-        elif sec.element.find("title") is not None:
-            return sec.element.find("title").text
-        else:
-            return ""
+        return self._annotate(t)[1]
 
     def get_top_level_sec_tag(self, t):
-        pos = t.start
-        hits = []
-        for s in sorted(self.standoffs, key=lambda x: x.start):
-            if pos >= s.start and pos < s.end and s != t:
-                hits.append(s)
-        for t in hits:
-            if t.element.tag == "sec":
-                if t.element.get("sec-type", None):
-                    return t.element.get("sec-type")
-                elif t.element.find("title") is not None:
-                    return t.element.find("title").text
-        return ""
+        return self._annotate(t)[2]
 
     def generate_tag_tree(self, t):
-        pos = t.start
-        hits = []
-        for s in sorted(self.standoffs, key=lambda x: x.start):
-            if pos >= s.start and pos < s.end and s != t:
-                hits.append(s)
+        hits = self._containing(t)
         # tag_tree = '|'.join(['%s[%s...]'%(t.element.tag,self.text[t.start:t.start+8]) if t.element.tag=='sec' else t.element.tag for t in hits])
-        tag_tree = "|".join([t.element.tag for t in hits])
-        tag_tree = tag_tree + "." + t.element.tag
+        tag_tree = "|".join([self._local_tag[id(s)] for s in hits])
+        tag_tree = tag_tree + "." + t.element.tag.rsplit("}", 1)[-1]
         return tag_tree
 
     def list_section_titles(self):
-        secs = [t for t in self.standoffs if t.element.tag == "sec"]
-        titles = [t.element.find("title").text.strip() for t in secs]
+        secs = self._by_tag.get("sec", [])
+        titles = [self._sec_title_el[id(t)].text.strip() for t in secs]
         levels = [self.generate_tag_tree(t).count("|") for t in secs]
         return (titles, levels)
 
     def search_section_titles(self, query):
         standoffs = []
-        for s in self.standoffs:
-            if s.element.tag == "sec":
-                title_tag = s.element.find("title")
-                if (
-                    title_tag and title_tag.text and query in title_tag.text.lower()
-                ) or query in s.element.get("sec-type", ""):
-                    standoffs.append(s)
+        for s in self._by_tag.get("sec", []):
+            title_tag = self._sec_title_el[id(s)]
+            if (
+                title_tag is not None
+                and title_tag.text
+                and query in title_tag.text.lower()
+            ) or query in (self._sec_type[id(s)] or ""):
+                standoffs.append(s)
         return standoffs
 
     def read_section_text(self, t):
-        hits = []
-        for s in sorted(self.standoffs, key=lambda x: x.start):
-            if (
-                s.start > t.start
-                and s.end < t.end
-                and s != t
-                and (s.element.tag == "p" or s.element.tag == "title")
-            ):
-                hits.append(s)
-        return "\n".join([re.sub("\s+", " ", self.text[t.start : t.end]) for t in hits])
+        # binary-search the window of standoffs starting inside t rather
+        # than filtering the full sorted list
+        lo = bisect.bisect_right(self._starts, t.start)
+        hi = bisect.bisect_left(self._starts, t.end, lo)
+        hits = [
+            s
+            for s in self._standoffs_by_start[lo:hi]
+            if s.end < t.end and self._local_tag[id(s)] in ("p", "title")
+        ]
+        return "\n".join(_WS_RE.sub(" ", self.text[h.start : h.end]) for h in hits)
+
+    # column names and integer dtypes for the document dataframes;
+    # building column-wise with explicit dtypes avoids pandas' dtype
+    # inference pass over a list of row tuples
+    _INT32_COLUMNS = ("PARAGRAPH_ID", "OFFSET", "LENGTH")
+    _CATEGORICAL_COLUMNS = ("TAG", "TOP_SECTION", "SECTION")
+
+    def _columns_to_dataframe(self, columns):
+        """Builds the document dataframe from a dict of column-name ->
+        list of values, coercing the offset-like columns to int32 and
+        the heavily repeated label columns to categoricals."""
+        data = {}
+        for name, values in columns.items():
+            if name in self._INT32_COLUMNS:
+                data[name] = np.asarray(values, dtype=np.int32)
+            elif name in self._CATEGORICAL_COLUMNS:
+                data[name] = pd.Categorical(values)
+            else:
+                data[name] = values
+        return pd.DataFrame(data)
 
     def build_simple_document_dataframe(self):
-        text_tuples = []
+        columns = {
+            "PMID": [],
+            "PARAGRAPH_ID": [],
+            "TAG": [],
+            "TOP_SECTION": [],
+            "SECTION_TREE": [],
+            "SECTION": [],
+            "OFFSET": [],
+            "LENGTH": [],
+            "FIG_REF": [],
+            "PLAIN_TEXT": [],
+        }
+
+        filled = 0
 
         try:
-            # two stage process - build a lookup list of all relevant tags
+            # two stage process - use the precomputed per-tag buckets
             # - then use the tags start/end properties to identify text portions of the paper and render those.
 
-            this_doc_standoffs = {
-                t: [] for tt in self.tag_types.keys() for t in self.tag_types[tt]
-            }
-
-            all_xrefs = []
-            for s in self.standoffs:
-                if this_doc_standoffs.get(s.element.tag) is not None:
-                    this_doc_standoffs.get(s.element.tag).append(s)
-                if s.element.tag == "xref":
-                    all_xrefs.append(s)
             #
             # skip the whole file if there's no body tag.
             #
-            if len(this_doc_standoffs.get("body")) == 0:
+            if len(self._by_tag.get("body", [])) == 0:
                 return None
 
             text_so_list = []
             for ttt in self.text_tag_types:
                 part, tag = ttt.split("/")
-                if len(this_doc_standoffs.get(part)) == 0:
+                if len(self._by_tag.get(part, [])) == 0:
                     continue
-                part_so = this_doc_standoffs.get(part)[0]
-                for so in this_doc_standoffs.get(tag):
+                part_so = self._by_tag.get(part)[0]
+                for so in self._by_tag.get(tag, []):
                     if so.start < part_so.start or so.end > part_so.end:
                         continue
                     text_so_list.append(so)
                     # print((row.PMID, local_id, so.element.tag, query_document_standoffs(so, text, standoffs), so.start, (so.end-so.start), text[so.start:so.end]))
 
-            # Manipulate standoff annotations so that titles and labels fall naturally in the text
-            # and paragraph tags that hold other paragraphs (as is the case with pmid:26791617) don't trigger repeating text.
-            # Make sure the SOs only tile the document and do not overlap.
-            text_so_list = sorted(text_so_list, key=lambda x: x.start)
-            last_so = None
-            for so in text_so_list:
-                if last_so:
-                    if last_so.end > so.start:
-                        last_so.end = so.start - 1
-                last_so = so
+            text_so_list = self._tile_text_standoffs(text_so_list)
+
+            # pre-size the columns and index-assign instead of growing
+            # each list by appending one value per row
+            for name in columns:
+                columns[name] = [None] * len(text_so_list)
 
             for local_id, so in enumerate(text_so_list):
-                sec_tree = self.get_sec_tree(so)
-                sec_title = self.get_sec_tag(so)
-                top_sec_title = self.get_top_level_sec_tag(so)
-                figure_reference = self.get_figure_reference(so)
+                sec_tree, sec_title, top_sec_title, figure_reference = self._context(
+                    so
+                )
                 so_text = self.text[so.start : so.end]
-                if so.element.tag == "article-title" or so.element.tag == "abstract":
+                if self._local_tag[id(so)] in ("article-title", "abstract"):
                     sec_title = "TIAB"
                     top_sec_title = "TIAB"
                     sec_tree = "TIAB"
-                tuple = (
-                    self.ft_id,
-                    local_id,
-                    so.element.tag,
-                    top_sec_title,
-                    sec_tree,
-                    sec_title,
-                    so.start,
-                    (so.end - so.start),
-                    figure_reference,
-                    so_text,
-                )
-                text_tuples.append(tuple)
+                columns["PMID"][local_id] = self.ft_id
+                columns["PARAGRAPH_ID"][local_id] = local_id
+                columns["TAG"][local_id] = self._local_tag[id(so)]
+                columns["TOP_SECTION"][local_id] = top_sec_title
+                columns["SECTION_TREE"][local_id] = sec_tree
+                columns["SECTION"][local_id] = sec_title
+                columns["OFFSET"][local_id] = so.start
+                columns["LENGTH"][local_id] = so.end - so.start
+                columns["FIG_REF"][local_id] = figure_reference
+                columns["PLAIN_TEXT"][local_id] = so_text
+                filled = local_id + 1
 
         except etree.XMLSyntaxError as xmlErr:
             print("XML Syntax Error: {0}".format(xmlErr))
@@ -327,22 +514,149 @@ class NxmlDoc:
         #    print("ValueError: {0}".format(valErr))
         #    return None
 
-        text_df = pd.DataFrame(
-            text_tuples,
-            columns=[
-                "PMID",
-                "PARAGRAPH_ID",
-                "TAG",
-                "TOP_SECTION",
-                "SECTION_TREE",
-                "SECTION",
-                "OFFSET",
-                "LENGTH",
-                "FIG_REF",
-                "PLAIN_TEXT",
-            ],
-        )
-        return text_df
+        if filled != len(columns["PMID"]):
+            # an exception cut the loop short; keep only complete rows
+            columns = {name: values[:filled] for name, values in columns.items()}
+        return self._columns_to_dataframe(columns)
+
+    def _tile_text_standoffs(self, text_so_list):
+        """Sorts the text standoffs by start offset and clips each one's
+        end so that consecutive standoffs tile the document without
+        overlapping. Titles and labels then fall naturally in the text
+        and paragraph tags that hold other paragraphs (as is the case
+        with pmid:26791617) don't trigger repeating text."""
+        text_so_list = sorted(text_so_list, key=lambda x: x.start)
+        last_so = None
+        for so in text_so_list:
+            if last_so:
+                if last_so.end > so.start:
+                    last_so.end = so.start - 1
+                    # keep the structure-of-arrays mirror consistent
+                    self._np_ends[self._so_index[id(last_so)]] = last_so.end
+            last_so = so
+        return text_so_list
+
+    # minimum number of text standoffs before the enhanced builder
+    # spreads row construction over a thread pool; below this the pool
+    # startup costs more than the rows
+    _PARALLEL_ROW_THRESHOLD = 16
+
+    def _enhanced_row(self, so, ref_dict, all_xrefs, xref_starts, get_compiled_refs):
+        """Computes one row of the enhanced dataframe for a text
+        standoff: its section annotations plus the passage text with
+        citation and figure xrefs substituted in. Reads only frozen
+        shared state so rows can be computed concurrently."""
+        sec_tree, sec_title, top_sec_title, figure_reference = self._context(so)
+
+        # ANY EXCLUSION CRITERIA FOR TAGS PUT IT HERE
+
+        # SEARCH FOR XREFS IN THIS TEXT BLOCK - AND SUB THEM INTO THE TEXT.
+        so_text = ""
+        prev_end = so.start
+        # one bounded walk over the xrefs starting inside this
+        # standoff, partitioned by ref-type
+        lo = bisect.bisect_left(xref_starts, so.start)
+        hi = bisect.bisect_right(xref_starts, so.end, lo)
+        so_xrefs = [
+            (x, x.element.attrib["ref-type"])
+            for x in all_xrefs[lo:hi]
+            if x.end <= so.end
+        ]
+        ref_xrefs = [x for x, ref_type in so_xrefs if ref_type == "bibr"]
+        # print(ref_xrefs)
+
+        if len(ref_xrefs) > 0:
+            refbib_xrefs = [
+                x for x, ref_type in so_xrefs if ref_type in ("bibr", "fig")
+            ]
+            for x in refbib_xrefs:
+                if x.element.attrib["ref-type"] == "bibr":
+                    ref_id = x.element.attrib["rid"]
+                    ref = ref_dict.get(ref_id, None)
+                    if ref and ref.get("pmid"):
+                        ref_text = "<<REF:%s>>" % (ref.get("pmid"))
+                    elif ref:
+                        ref_text = "<<REF:%s-%s-%s-%s>>" % (
+                            ref.get("first_author", "???"),
+                            ref.get("year", "?"),
+                            ref.get("vol", "?"),
+                            ref.get("page", "?"),
+                        )
+                    else:
+                        ref_text = "<<REF>>"
+                    so_text += self.text[prev_end : x.start] + ref_text
+                else:
+                    fig_id = x.element.attrib["rid"]
+                    fig_text = "%s <<FIG:%s>>" % (
+                        self.text[x.start : x.end],
+                        fig_id,
+                    )
+                    so_text += self.text[prev_end : x.start] + fig_text
+                # print(pmid, ref_id, ref_text)
+                prev_end = x.end
+
+            # if len(so_text)>0:
+            #  print(so_text)
+            so_text += self.text[prev_end : so.end]
+            so_text = html.unescape(so_text)
+        # __________________________________________________________________
+        else:  # USE REGEXES TO SUBSTITUTE REFERENCES IN PASSAGE TEXT
+            fig_xrefs = [x for x, ref_type in so_xrefs if ref_type == "fig"]
+            so_text = ""
+            prev_end = so.start
+            for x in fig_xrefs:
+                fig_id = x.element.attrib["rid"]
+                fig_text = "%s <<FIG:%s>>" % (
+                    self.text[x.start : x.end],
+                    fig_id,
+                )
+                so_text += self.text[prev_end : x.start] + fig_text
+                prev_end = x.end
+            so_text += self.text[prev_end : so.end]
+            so_text = html.unescape(so_text)
+
+            # print(so_text)
+            for pattern, ref_text in get_compiled_refs():
+                if pattern.search(so_text):
+                    so_text = pattern.sub(ref_text, so_text)
+                # print( pattern.sub(ref_text,so_text))
+
+        return sec_tree, sec_title, top_sec_title, figure_reference, so_text
+
+    def _compile_ref_patterns(self, ref_dict):
+        """Returns a list of (compiled pattern, replacement) pairs for
+        regex-based citation substitution, one per reference. Compiled
+        once per document so the per-standoff fallback loop in
+        build_enhanced_document_dataframe doesn't recompile them."""
+        compiled_refs = []
+        for ref in ref_dict.values():
+            if ref.get("pmid"):
+                ref_text = " <<REF:%s>> " % (ref.get("pmid"))
+            else:
+                ref_text = " <<REF:%s-%s-%s-%s>> " % (
+                    ref.get("first_author", "???"),
+                    ref.get("year", "?"),
+                    ref.get("vol", "?"),
+                    ref.get("page", "?"),
+                )
+            if ref.get("year") and ref.get("second_author"):
+                regex = "%s( and %s,|,|\\s+et al\\.\\,|\\s+et al){0,1}\\s+%s" % (
+                    ref.get("first_author", ""),
+                    ref.get("second_author", ""),
+                    ref.get("year", ""),
+                )
+            elif ref.get("year") and len(ref.get("first_author", "")) > 0:
+                regex = "%s(,|\\s+et al\\.\\,|\\s+et al){0,1}\\s+%s" % (
+                    ref.get("first_author", ""),
+                    ref.get("year", ""),
+                )
+            else:
+                regex = (
+                    "%s( and [A-Za-z]+|,|\\s+et al\\.\\,|\\s+et al){0,1}\\s+(19|20)[0-9][0-9]"
+                    % (ref.get("first_author", ""))
+                )
+            compiled_refs.append((re.compile(regex), ref_text))
+        return compiled_refs
 
     def build_enhanced_document_dataframe(self):
         """This method processes the JATS file and returns a dataframe with the following columns:
@@ -359,256 +673,130 @@ class NxmlDoc:
         PLAIN_TEXT: the text itself
         """
 
-        text_tuples = []
+        columns = {
+            "PMID": [],
+            "PARAGRAPH_ID": [],
+            "TAG": [],
+            "TOP_SECTION": [],
+            "SECTION_TREE": [],
+            "SECTION": [],
+            "OFFSET": [],
+            "LENGTH": [],
+            "FIG_REF": [],
+            "PLAIN_TEXT": [],
+        }
+
+        filled = 0
 
         try:
-            # two stage process - build a lookup list of all relevant tags
+            # two stage process - use the precomputed per-tag buckets
             # - then use the tags start/end properties to identify text portions of the paper and render those.
 
-            this_doc_standoffs = {
-                t: [] for tt in self.tag_types.keys() for t in self.tag_types[tt]
-            }
-
-            all_xrefs = []
-            for s in self.standoffs:
-                # temporary hack to deal with namespaces. 
-                t = re.sub('\{.*?\}', '', s.element.tag)
-                if this_doc_standoffs.get(t) is not None:
-                    this_doc_standoffs.get(t).append(s)
-                if t == "xref":
-                    all_xrefs.append(s)
+            all_xrefs = self._by_tag.get("xref", [])
             #
             # skip the whole file if there's no body tag.
             #
-            if len(this_doc_standoffs.get("body")) == 0:
+            if len(self._by_tag.get("body", [])) == 0:
                 return None
 
             ref_dict = self.extract_ref_dict_from_nxml()
 
+            # xrefs sorted by start offset so each text standoff can
+            # bisect its own window instead of rescanning the full list
+            all_xrefs = sorted(all_xrefs, key=lambda x: x.start)
+            xref_starts = [x.start for x in all_xrefs]
+
+            # (pattern, replacement) pairs for regex-based citation
+            # substitution, compiled lazily on first use so every text
+            # standoff shares them instead of recompiling one regex per
+            # ref per standoff; the lock keeps lazy compilation safe
+            # when the rows are processed in parallel
+            compiled_refs_box = [None]
+            compile_lock = threading.Lock()
+
+            def get_compiled_refs():
+                with compile_lock:
+                    if compiled_refs_box[0] is None:
+                        compiled_refs_box[0] = self._compile_ref_patterns(ref_dict)
+                    return compiled_refs_box[0]
+
             text_so_list = []
             for ttt in self.text_tag_types:
                 part, tag = ttt.split("/")
-                part_so = this_doc_standoffs.get(part)[0]
-                for so in this_doc_standoffs.get(tag):
+                part_so = self._by_tag.get(part, [])[0]
+                for so in self._by_tag.get(tag, []):
                     if so.start < part_so.start or so.end > part_so.end:
                         continue
                     text_so_list.append(so)
                     # print((row.PMID, local_id, so.element.tag, query_document_standoffs(so, text, standoffs), so.start, (so.end-so.start), text[so.start:so.end]))
 
-            # Manipulate standoff annotations so that titles and labels fall naturally in the text
-            # and paragraph tags that hold other paragraphs (as is the case with pmid:26791617) don't trigger repeating text.
-            # Make sure the SOs only tile the document and do not overlap.
-            text_so_list = sorted(text_so_list, key=lambda x: x.start)
-            last_so = None
-            for so in text_so_list:
-                if last_so:
-                    if last_so.end > so.start:
-                        last_so.end = so.start - 1
-                last_so = so
+            text_so_list = self._tile_text_standoffs(text_so_list)
 
-            for local_id, so in enumerate(text_so_list):
-                sec_tree = self.get_sec_tree(so)
-                sec_title = self.get_sec_tag(so)
-                top_sec_title = self.get_top_level_sec_tag(so)
-                figure_reference = self.get_figure_reference(so)
-
-                # ANY EXCLUSION CRITERIA FOR TAGS PUT IT HERE
-
-                # SEARCH FOR XREFS IN THIS TEXT BLOCK - AND SUB THEM INTO THE TEXT.
-                so_text = ""
-                prev_end = so.start
-                ref_xrefs = [
-                    x
-                    for x in all_xrefs
-                    if x.start >= so.start
-                    and x.end <= so.end
-                    and x.element.attrib["ref-type"] == "bibr"
-                ]
-                # print(ref_xrefs)
-
-                if len(ref_xrefs) > 0:
-                    refbib_xrefs = [
-                        x
-                        for x in all_xrefs
-                        if x.start >= so.start
-                        and x.end <= so.end
-                        and (
-                            x.element.attrib["ref-type"] == "bibr"
-                            or x.element.attrib["ref-type"] == "fig"
-                        )
-                    ]
-                    for x in refbib_xrefs:
-                        if x.element.attrib["ref-type"] == "bibr":
-                            ref_id = x.element.attrib["rid"]
-                            ref = ref_dict.get(ref_id, None)
-                            if ref and ref.get("pmid"):
-                                ref_text = "<<REF:%s>>" % (ref.get("pmid"))
-                            elif ref:
-                                ref_text = "<<REF:%s-%s-%s-%s>>" % (
-                                    ref.get("first_author", "???"),
-                                    ref.get("year", "?"),
-                                    ref.get("vol", "?"),
-                                    ref.get("page", "?"),
-                                )
-                            else:
-                                ref_text = "<<REF>>"
-                            so_text += self.text[prev_end : x.start] + ref_text
-                        else:
-                            fig_id = x.element.attrib["rid"]
-                            fig_text = "%s <<FIG:%s>>" % (
-                                self.text[x.start : x.end],
-                                fig_id,
-                            )
-                            so_text += self.text[prev_end : x.start] + fig_text
-                        # print(pmid, ref_id, ref_text)
-                        prev_end = x.end
-
-                    # if len(so_text)>0:
-                    #  print(so_text)
-                    so_text += self.text[prev_end : so.end]
-                    so_text = html.unescape(so_text)
-                # __________________________________________________________________
-                else:  # USE REGEXES TO SUBSTITUTE REFERENCES IN PASSAGE TEXT
-                    fig_xrefs = [
-                        x
-                        for x in all_xrefs
-                        if x.start >= so.start
-                        and x.end <= so.end
-                        and x.element.attrib["ref-type"] == "fig"
-                    ]
-                    so_text = ""
-                    prev_end = so.start
-                    for x in fig_xrefs:
-                        fig_id = x.element.attrib["rid"]
-                        fig_text = "%s <<FIG:%s>>" % (
-                            self.text[x.start : x.end],
-                            fig_id,
-                        )
-                        so_text += self.text[prev_end : x.start] + fig_text
-                        prev_end = x.end
-                    so_text += self.text[prev_end : so.end]
-                    so_text = html.unescape(so_text)
-
-                    # print(so_text)
-                    for key in ref_dict:
-                        ref = ref_dict[key]
-                        if ref.get("pmid"):
-                            ref_text = " <<REF:%s>> " % (ref.get("pmid"))
-                        else:
-                            ref_text = " <<REF:%s-%s-%s-%s>> " % (
-                                ref.get("first_author", "???"),
-                                ref.get("year", "?"),
-                                ref.get("vol", "?"),
-                                ref.get("page", "?"),
-                            )
-                        if ref.get("year") and ref.get("second_author"):
-                            regex = (
-                                "%s( and %s,|,|\\s+et al\\.\\,|\\s+et al){0,1}\\s+%s"
-                                % (
-                                    ref.get("first_author", ""),
-                                    ref.get("second_author", ""),
-                                    ref.get("year", ""),
-                                )
-                            )
-                        elif ref.get("year") and len(ref.get("first_author", "")) > 0:
-                            regex = "%s(,|\\s+et al\\.\\,|\\s+et al){0,1}\\s+%s" % (
-                                ref.get("first_author", ""),
-                                ref.get("year", ""),
-                            )
-                        else:
-                            regex = (
-                                "%s( and [A-Za-z]+|,|\\s+et al\\.\\,|\\s+et al){0,1}\\s+(19|20)[0-9][0-9]"
-                                % (ref.get("first_author", ""))
-                            )
-                        pattern = re.compile(regex)
-                        if pattern.search(so_text):
-                            so_text = pattern.sub(ref_text, so_text)
-                        # print( pattern.sub(ref_text,so_text))
-
-                tuple = (
-                    self.ft_id,
-                    local_id,
-                    re.sub('\{.*?\}', '', so.element.tag),
-                    top_sec_title,
-                    sec_tree,
-                    sec_title,
-                    so.start,
-                    (so.end - so.start),
-                    figure_reference,
-                    so_text,
+            # pre-size the columns and index-assign instead of growing
+            # each list by appending one value per row
+            for name in columns:
+                columns[name] = [None] * len(text_so_list)
+
+            def process_so(so):
+                return self._enhanced_row(
+                    so, ref_dict, all_xrefs, xref_starts, get_compiled_refs
                 )
-                text_tuples.append(tuple)
+
+            # the per-row work only reads shared state once the tiling
+            # above has frozen the standoff ends, so rows can be
+            # computed in parallel; ex.map keeps result order, and the
+            # serial path is kept for short documents where pool
+            # startup would dominate
+            if len(text_so_list) >= self._PARALLEL_ROW_THRESHOLD:
+                executor = ThreadPoolExecutor(max_workers=8)
+                rows = executor.map(process_so, text_so_list)
+            else:
+                executor = None
+                rows = map(process_so, text_so_list)
+
+            try:
+                for local_id, (so, row) in enumerate(zip(text_so_list, rows)):
+                    sec_tree, sec_title, top_sec_title, figure_reference, so_text = row
+                    columns["PMID"][local_id] = self.ft_id
+                    columns["PARAGRAPH_ID"][local_id] = local_id
+                    columns["TAG"][local_id] = self._local_tag[id(so)]
+                    columns["TOP_SECTION"][local_id] = top_sec_title
+                    columns["SECTION_TREE"][local_id] = sec_tree
+                    columns["SECTION"][local_id] = sec_title
+                    columns["OFFSET"][local_id] = so.start
+                    columns["LENGTH"][local_id] = so.end - so.start
+                    columns["FIG_REF"][local_id] = figure_reference
+                    columns["PLAIN_TEXT"][local_id] = so_text
+                    filled = local_id + 1
+            finally:
+                if executor is not None:
+                    executor.shutdown()
 
         except etree.XMLSyntaxError as xmlErr:
             print("XML Syntax Error: {0}".format(xmlErr))
         except UnicodeDecodeError as unicodeErr:
             print("Unicode parsing Error: {0}".format(unicodeErr))
 
-        text_df = pd.DataFrame(
-            text_tuples,
-            columns=[
-                "PMID",
-                "PARAGRAPH_ID",
-                "TAG",
-                "TOP_SECTION",
-                "SECTION_TREE",
-                "SECTION",
-                "OFFSET",
-                "LENGTH",
-                "FIG_REF",
-                "PLAIN_TEXT",
-            ],
-        )
-        return text_df
+        if filled != len(columns["PMID"]):
+            # an exception cut the loop short; keep only complete rows
+            columns = {name: values[:filled] for name, values in columns.items()}
+        return self._columns_to_dataframe(columns)
 
     def extract_ref_dict_from_nxml(self, search_pubmed=False):
         if self.xml is None:
             return
 
-        soup = BeautifulSoup(self.xml, "lxml-xml")
-
-        references = soup.find_all("ref")
         all_ref_dict = {}
-        for r in references:
+        for r in self._by_tag.get("ref", []):
             ref_dict = {}
-            ref_dict["ref"] = r.attrs.get("id")
+            ref_dict["ref"] = r.element.get("id")
 
             ref_dict["author"] = ""
-            for t in r.descendants:
-                if (
-                    type(t) is Tag
-                    and t.name == "surname"
-                    and ref_dict.get("first_author", None) is None
-                ):
-                    ref_dict["first_author"] = re.sub("'", "''", t.text)
-                if (
-                    type(t) is Tag
-                    and t.name == "surname"
-                    and ref_dict.get("first_author", None) is not None
-                ):
-                    ref_dict["second_author"] = re.sub("'", "''", t.text)
-                if (
-                    type(t) is Tag
-                    and t.name == "name"
-                    and len(ref_dict.get("author")) > 0
-                ):
-                    ref_dict["author"] += ", "
-                if type(t) is Tag and t.name == "surname":
-                    ref_dict["author"] += re.sub("'", "''", t.text)
-                if type(t) is Tag and t.name == "given-names":
-                    ref_dict["author"] += " " + re.sub("'", "''", t.text)
-                elif type(t) is Tag and t.name == "article-title":
-                    ref_dict["title"] = re.sub("'", "''", t.text)
-                elif type(t) is Tag and t.name == "source":
-                    ref_dict["journal"] = t.text
-                elif type(t) is Tag and t.name == "year":
-                    m = re.match("(\\d\\d\\d\\d)", t.text)
-                    if m:
-                        ref_dict["year"] = m.group(1)
-                elif type(t) is Tag and t.name == "volume":
-                    ref_dict["vol"] = t.text
-                elif type(t) is Tag and t.name == "fpage":
-                    ref_dict["page"] = t.text
+            for el in r.element.iter():
+                handler = _REF_FIELD_HANDLERS.get(el.tag.rpartition("}")[2])
+                if handler is not None:
+                    # all descendant text, matching bs4's Tag.text
+                    handler("".join(el.itertext()), ref_dict)
 
             all_ref_dict[ref_dict.get("ref")] = ref_dict
 
@@ -644,29 +832,36 @@ class NxmlDoc:
                 "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pubmed&api_key="
                 + pubmed_api_key
             )
+            # the esearch calls are independent, so issue them over a
+            # pooled session in parallel instead of paying one network
+            # round trip after another
+            urls = [
+                stem1 + "&db=pubmed&term=" + "+OR+".join(clauses[i : i + 50])
+                for i in range(0, len(clauses), 50)
+            ]
             pmids = []
-            for i in range(0, len(clauses), 50):
-                query1 = "+OR+".join(clauses[i : i + 50])
-                r1 = requests.get(stem1 + "&db=pubmed&term=" + query1)
-                soup2 = BeautifulSoup(r1.text, "lxml-xml")
-
-                for id in soup2.find_all("id"):
-                    pmids.append(id.text)
+            with requests.Session() as session:
+                with ThreadPoolExecutor(max_workers=8) as ex:
+                    responses = list(ex.map(session.get, urls))
+            for r1 in responses:
+                root1 = etree.fromstring(r1.content)
+                for id_el in root1.iter("Id"):
+                    pmids.append(id_el.text)
 
             stem2 = (
                 "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&api_key="
                 + pubmed_api_key
             )
             for i in range(0, len(pmids), 50):
-                query2 = ",".join(clauses[i : i + 50])
+                query2 = ",".join(pmids[i : i + 50])
                 r2 = requests.get(stem2 + "&db=pubmed&id=" + query2)
-                soup2 = BeautifulSoup(r2.text, "lxml-xml")
-                for article_tag in soup2.find_all("PubmedArticle"):
-                    first_author = article_tag.find("Author").find("LastName").text
-                    year = article_tag.find("PubDate").find("Year").text
-                    vol = article_tag.find("Volume").text
-                    page = article_tag.find("StartPage").text
-                    pmid = article_tag.find("PMID").text
+                root2 = etree.fromstring(r2.content)
+                for article_el in root2.iter("PubmedArticle"):
+                    first_author = article_el.findtext(".//Author/LastName")
+                    year = article_el.findtext(".//PubDate/Year")
+                    vol = article_el.findtext(".//Volume")
+                    page = article_el.findtext(".//StartPage")
+                    pmid = article_el.findtext(".//PMID")
                     all_ref_dict[
                         ("%s-%s-%s-%s" % (first_author, year, vol, page)).lower()
                     ] = pmid
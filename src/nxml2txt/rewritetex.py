@@ -13,6 +13,9 @@ from __future__ import with_statement
 import sys
 import os
 import re
+import threading
+
+from hashlib import blake2b
 
 from lxml import etree as ET
 
@@ -30,7 +33,7 @@ ORIG_TEXT_ATTRIBUTE = "orig-text"
 
 # command for invoking tex (-interaction=nonstopmode makes latex try
 # to proceed on error without waiting for input.)
-TEX_COMMAND = "latex -interaction=nonstopmode"
+TEX_COMMAND = ["latex", "-interaction=nonstopmode"]
 
 # directory into which to instruct tex to place its output.
 if os.environ.get("TMPDIR"):
@@ -41,7 +44,7 @@ else:
 # command for invokind catdvi (-e 0 specifies output encoding in UTF-8,
 # and -s sets sequential mode, which turns off attempt to reproduce
 # layout such as sub- and superscript positioning.)
-CATDVI_COMMAND = "catdvi -e 0 -s"
+CATDVI_COMMAND = ["catdvi", "-e", "0", "-s"]
 
 # path to on-disk caches of tex document -> text mappings
 PICKLE_CACHE_PATH = os.path.join(os.path.dirname(__file__), "data/tex2txt.cache")
@@ -50,23 +53,106 @@ SQLITE_CACHE_PATH = os.path.join(os.path.dirname(__file__), "data/tex2txt.db")
 INPUT_ENCODING = "UTF-8"
 OUTPUT_ENCODING = "UTF-8"
 
+# optional DFA-based regex engine: google-re2 matches in time linear
+# in the input with a much smaller per-byte constant than the stdlib
+# backtracking engine, which pays off on the patterns below that run
+# once per formula over large corpora. Fall back silently to the
+# stdlib engine when re2 is not installed (it is in the "fast" extra).
+try:
+    import re2 as _re_fast
+except ImportError:
+    _re_fast = re
+
+
+def _compile_fast(pattern):
+    try:
+        return _re_fast.compile(pattern)
+    except Exception:
+        # the alternate engine rejects some constructs; the stdlib
+        # engine accepts everything we use
+        return re.compile(pattern)
+
+
 # pre-compiled regular expressions
 
-# key declarations in tex documents
-texdecl_re = re.compile(
-    r"(\\(?:documentclass|usepackage|setlength|pagestyle)(?:\[[^\[\]]*\])?(?:\{[^\{\}]*\})*)"
-)
 # document start or end
 texdoc_re = re.compile(r"(\\(?:begin|end)(?:\[[^\[\]]*\])?\{document\})")
-# includes for "standard" tex packages
-texstdpack_re = re.compile(
-    r"\\usepackage\{(?:amsbsy|amsfonts|amsmath|amssymb|mathrsfs|upgreek|wasysym)\}"
+# normalization pattern: a run of whitespace and/or header boilerplate
+# declarations (documentclass, package includes etc.). Matching whole
+# runs rather than alternatives lets a single sub() both delete the
+# declarations and collapse the surrounding space without leaving
+# doubled spaces behind; group 1 records whether the run contained any
+# whitespace of its own (declaration arguments may contain spaces,
+# which do not count).
+texnorm_re = _compile_fast(
+    r"(?:(\s+)"
+    r"|\\(?:documentclass|usepackage|setlength|pagestyle)"
+    r"(?:\[[^\[\]]*\])?(?:\{[^\{\}]*\})*)+"
+)
+# document body, for splitting batched compilations
+texbody_re = re.compile(r"\\begin\{document\}(.*)\\end\{document\}", re.DOTALL)
+# the "minimal" document class (see _pmc_tex_tweaks)
+texminimal_re = re.compile(r"(\\documentclass(?:\[[^\[\]]*\])?\{)minimal(\})")
+# the line of tex output naming the produced file
+outputwritten_re = re.compile(r"Output written on (\S+)")
+# trivial formula bodies that can be converted without invoking tex: a
+# single (possibly braced) letter, a lone greek-letter command, or a
+# simply sub-/superscripted letter
+fasttex_re = _compile_fast(
+    r"^\$\s*\{?\s*(?:"
+    r"(?P<letter>[A-Za-z])"
+    r"|\\(?P<greek>[a-zA-Z]+)"
+    r"|(?P<base>[A-Za-z])\s*[_^]\s*\{?(?P<script>[0-9A-Za-z])\}?"
+    r")\s*\}?\s*\$$"
 )
-# consequtive space
-space_re = re.compile(r"\s+")
-# initial and terminal space.
-docstartspace_re = re.compile(r"^\s*")
-docendspace_re = re.compile(r"\s*$")
+
+# greek-letter commands for the trivial-formula fast path
+GREEK = {
+    "alpha": "α",
+    "beta": "β",
+    "gamma": "γ",
+    "delta": "δ",
+    "epsilon": "ε",
+    "varepsilon": "ε",
+    "zeta": "ζ",
+    "eta": "η",
+    "theta": "θ",
+    "vartheta": "θ",
+    "iota": "ι",
+    "kappa": "κ",
+    "lambda": "λ",
+    "mu": "μ",
+    "nu": "ν",
+    "xi": "ξ",
+    "pi": "π",
+    "rho": "ρ",
+    "varrho": "ρ",
+    "sigma": "σ",
+    "varsigma": "ς",
+    "tau": "τ",
+    "upsilon": "υ",
+    "phi": "φ",
+    "varphi": "φ",
+    "chi": "χ",
+    "psi": "ψ",
+    "omega": "ω",
+    "Gamma": "Γ",
+    "Delta": "Δ",
+    "Theta": "Θ",
+    "Lambda": "Λ",
+    "Xi": "Ξ",
+    "Pi": "Π",
+    "Sigma": "Σ",
+    "Upsilon": "Υ",
+    "Phi": "Φ",
+    "Psi": "Ψ",
+    "Omega": "Ω",
+}
+
+# sentinel written between formulae in a batched compilation so that
+# the catdvi output can be split back into per-formula strings
+BATCH_SEPARATOR = "<<<SEP:%d>>>"
+batchsep_re = re.compile(r"<<<SEP:(\d+)>>>")
 
 ##########
 
@@ -82,54 +168,22 @@ def normalize_tex(s):
     # commands in tex and more removing content-neutral formatting
     # more aggressively.
 
-    # remove "standard" package includes
-    s = texstdpack_re.sub("", s)
-
-    # remove header boilerplate declarations (superset of texstdpack_re)
-    s = texdecl_re.sub(r"", s)
+    # remove header boilerplate declarations and collapse runs of
+    # space in a single scan; a run reduces to a plain space only if
+    # it contained whitespace outside the deleted declarations
+    return texnorm_re.sub(
+        lambda m: "" if m.group(1) is None else " ", s
+    ).strip()
 
-    # replace any amount of consequtive space by a single plain space
-    s = space_re.sub(" ", s)
 
-    # eliminate doc-initial and -terminal space.
-    s = docstartspace_re.sub("", s)
-    s = docendspace_re.sub("", s)
-
-    return s
-
-
-def ordall(d):
+def cache_key(tex_norm):
     """
-    Given a dict with string values, returns an equivalent dict where
-    the strings have been transformed into arrays of integers. This is
-    a data "wrapper" to avoid a weird issue with cPickle where
-    undefined unicode chars were modified in the pickling/unpickling
-    process.  (Try to pickle unichr(0x10FF0C) to see if this affects
-    your setup)
+    Returns the compact cache key for a normalized tex document: a
+    16-byte blake2b digest. Hashing once per element beats letting
+    every cache layer re-hash or B-tree-compare multi-kilobyte tex
+    strings, and fixed-size keys keep the SQLite index pages dense.
     """
-    from copy import deepcopy
-
-    d = deepcopy(d)
-    for k in d.keys():
-        d[k] = [ord(c) for c in d[k]]
-    return d
-
-
-def unordall(d):
-    """
-    Given a dict with integer list values, returns an equivalent dict
-    where the int lists have been transformed into unicode strings.
-    This is a data "wrapper" to avoid a weird issue with cPickle where
-    undefined unicode chars were modified in the pickling/unpickling
-    process.  (Try to pickle unichr(0x10FF0C) to see if this affects
-    your setup)
-    """
-    from copy import deepcopy
-
-    d = deepcopy(d)
-    for k in d.keys():
-        d[k] = "".join([chr(c) for c in d[k]])
-    return d
+    return blake2b(tex_norm.encode("utf-8"), digest_size=16).digest()
 
 
 class Cache(object):
@@ -151,12 +205,19 @@ class PickleCache(Cache):
         super(PickleCache, self).__init__(map)
 
     def save(self, filename=PICKLE_CACHE_PATH):
-        from pickle import dump as pickle_dump
+        # marshal of a str->bytes dict is several times faster than
+        # pickling and produces smaller files; encoding the values to
+        # UTF-8 bytes also sidesteps the unicode pickling issue the
+        # legacy int-list format was a workaround for
+        import marshal
 
         try:
             with open(filename, "wb") as cache_file:
-                pickle_dump(ordall(self._map), cache_file)
-                cache_file.close()
+                marshal.dump(
+                    {k: v.encode("utf-8") for k, v in self._map.items()},
+                    cache_file,
+                    4,
+                )
         except IOError:
             sys.stderr.write("warning: failed to write cache.\n")
         except Exception:
@@ -164,12 +225,27 @@ class PickleCache(Cache):
 
     @classmethod
     def load(cls, filename=PICKLE_CACHE_PATH):
+        import marshal
         from pickle import UnpicklingError
         from pickle import load as pickle_load
 
         try:
             with open(filename, "rb") as cache_file:
-                map_ = unordall(pickle_load(cache_file))
+                try:
+                    map_ = {
+                        k: v.decode("utf-8")
+                        for k, v in marshal.load(cache_file).items()
+                    }
+                except (ValueError, EOFError, TypeError, AttributeError):
+                    # not a marshal dump; fall back to the legacy
+                    # pickle format, whose values are lists of
+                    # codepoints (a workaround for a long-fixed
+                    # unicode pickling bug), converting on the fly
+                    cache_file.seek(0)
+                    map_ = {
+                        k: "".join(map(chr, v))
+                        for k, v in pickle_load(cache_file).items()
+                    }
                 return cls(map_)
         except UnpicklingError:
             sys.stderr.write("warning: failed to read cache file.\n")
@@ -183,44 +259,170 @@ class PickleCache(Cache):
 
 
 class SqliteCache(Cache):
-    def __init__(self, db=None):
+    # how many uncommitted writes to batch into one transaction;
+    # committing per set forces an fsync per cache miss, which
+    # dominates cache-write time on corpora with many unique formulae
+    COMMIT_INTERVAL = 256
+
+    # bound on the in-memory layer; short formulae like "$n$" repeat
+    # dozens of times per document, and serving them from a dict saves
+    # a SQL round-trip per repeat
+    MEM_CACHE_SIZE = 10000
+
+    def __init__(self, db=None, overlay=False):
         super(SqliteCache, self).__init__(None)
         self.db = db
+        # one long-lived cursor instead of a cursor()/close() pair per
+        # call
+        self._cursor = db.cursor() if db is not None else None
+        self._dirty = 0
+        from collections import OrderedDict
+
+        self._mem = OrderedDict()
+        # in overlay mode the main database is a read-only warm cache
+        # (e.g. one shipped with the package); lookups consult it
+        # first and all writes go to the attached "local" database
+        if overlay:
+            self._select_sql = (
+                "SELECT txt FROM tex2txt WHERE tex = :key"
+                " UNION ALL SELECT txt FROM local.tex2txt WHERE tex = :key"
+                " LIMIT 1"
+            )
+            self._insert_sql = "INSERT OR REPLACE INTO local.tex2txt VALUES (?,?)"
+        else:
+            self._select_sql = "SELECT txt FROM tex2txt WHERE tex = :key"
+            self._insert_sql = "INSERT OR REPLACE INTO tex2txt VALUES (?,?)"
+
+    def _remember(self, key, value):
+        self._mem[key] = value
+        self._mem.move_to_end(key)
+        if len(self._mem) > self.MEM_CACHE_SIZE:
+            self._mem.popitem(last=False)
 
     def get(self, key):
-        cursor = self.db.cursor()
-        cursor.execute("SELECT txt FROM tex2txt WHERE tex = ?", (key,))
-        row = cursor.fetchone()
-        cursor.close()
+        if key in self._mem:
+            self._mem.move_to_end(key)
+            return self._mem[key]
+        self._cursor.execute(self._select_sql, {"key": key})
+        row = self._cursor.fetchone()
         if row is None:
             return None
-        else:
-            return row[0]
+        self._remember(key, row[0])
+        return row[0]
 
     def set(self, key, value):
-        cursor = self.db.cursor()
-        cursor.execute("INSERT OR REPLACE INTO tex2txt VALUES (?,?)", (key, value))
+        self._cursor.execute(self._insert_sql, (key, value))
+        self._remember(key, value)
+        self._dirty += 1
+        if self._dirty >= self.COMMIT_INTERVAL:
+            self.db.commit()
+            self._dirty = 0
+
+    def bulk_set(self, items):
+        """
+        Inserts (key, value) pairs in one executemany statement and a
+        single transaction, for seeding the database in bulk (e.g.
+        from a legacy pickle cache or a worker's collected entries).
+        """
+        items = list(items)
+        self._cursor.executemany(self._insert_sql, items)
+        for key, value in items:
+            self._remember(key, value)
         self.db.commit()
-        cursor.close()
+        self._dirty = 0
+
+    def flush(self):
+        """
+        Commits any batched writes without closing the connection.
+        """
+        if self._dirty:
+            self.db.commit()
+            self._dirty = 0
 
     def save(self):
+        self.flush()
         self.db.close()
         self.db = None
+        self._cursor = None
 
     @classmethod
     def load(cls, filename=SQLITE_CACHE_PATH):
         import sqlite3
 
+        # a pre-populated cache (e.g. one shipped with the package
+        # from a large PMC corpus) is best opened read-only and
+        # immutable, with new entries diverted to a per-user overlay
+        # database: every install then starts warm and the shared base
+        # is never modified or locked
+        if os.path.exists(filename):
+            try:
+                return cls._load_overlay(filename)
+            except (sqlite3.Error, OSError):
+                # not usable read-only (e.g. the table is missing, or
+                # no overlay location is available); fall back to the
+                # plain read-write cache below
+                pass
+
         db = sqlite3.connect(filename, timeout=SQLITE_TIMEOUT)
-        # make sure the map table exists
+        # WAL keeps readers (e.g. parallel workers) unblocked during
+        # commits, and NORMAL sync is durable enough for a rebuildable
+        # cache while skipping an fsync per transaction
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        # make sure the map table exists; WITHOUT ROWID stores the
+        # rows in the primary-key B-tree itself, one page fetch fewer
+        # per lookup (only takes effect for newly created databases;
+        # existing ones keep their rowid schema)
         cursor = db.cursor()
         cursor.execute(
-            "CREATE TABLE IF NOT EXISTS" "  tex2txt(tex TEXT PRIMARY KEY, txt TEXT)"
+            "CREATE TABLE IF NOT EXISTS"
+            " tex2txt(tex TEXT PRIMARY KEY, txt TEXT) WITHOUT ROWID"
         )
         db.commit()
         cursor.close()
         return cls(db)
 
+    @classmethod
+    def _load_overlay(cls, filename):
+        import sqlite3
+
+        # plain read-only, not immutable=1: a freshly created cache
+        # can still be receiving merged entries from the parent of a
+        # parallel run while workers read it, and immutable mode skips
+        # the locking that makes that safe
+        db = sqlite3.connect(
+            "file:%s?mode=ro" % filename, uri=True, timeout=SQLITE_TIMEOUT
+        )
+        try:
+            # confirm this is a usable cache before attaching the
+            # overlay (raises for an empty or foreign database)
+            db.execute("SELECT txt FROM tex2txt LIMIT 1").fetchone()
+            db.execute("ATTACH DATABASE ? AS local", (_overlay_db_path(),))
+            db.execute("PRAGMA local.journal_mode=WAL")
+            db.execute("PRAGMA local.synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS"
+                " local.tex2txt(tex TEXT PRIMARY KEY, txt TEXT) WITHOUT ROWID"
+            )
+            db.commit()
+        except Exception:
+            db.close()
+            raise
+        return cls(db, overlay=True)
+
+
+def _overlay_db_path():
+    """
+    Returns the path of the per-user writable database overlaid on a
+    read-only cache, creating its directory if needed.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    cache_dir = os.path.join(cache_home, "nxml2txt")
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, "tex2txt.db")
+
 
 def get_cache(cls=SqliteCache):
     try:
@@ -230,38 +432,113 @@ def get_cache(cls=SqliteCache):
         return cls()
 
 
-def tex_compile(fn):
+# precompiled format files by preamble, named so that parallel
+# processes don't clobber each other's dumps; the lock serializes
+# dumps from concurrent threads, which would otherwise race on the
+# intermediate mylatex.fmt file
+_format_cache = {}
+_format_lock = threading.Lock()
+
+
+def _preamble_format(preamble):
+    """
+    Returns the name of a precompiled tex format for the given
+    preamble, dumping one on first use with the mylatex.ltx bootstrap
+    shipped with standard tex distributions, or None if no format can
+    be produced (e.g. mylatex.ltx is not installed). A dumped format
+    lets every later compilation sharing the preamble skip re-reading
+    the document class and package files, which dominates startup for
+    short formulae. A latex process itself cannot be kept alive across
+    documents (it terminates at \\end{document}), so format reuse is
+    the persistent-state mechanism available here.
     """
-    Invokes tex to compile the file with the given name.
+
+    from subprocess import DEVNULL, PIPE, Popen
+    from tempfile import NamedTemporaryFile
+
+    with _format_lock:
+        if preamble in _format_cache:
+            return _format_cache[preamble]
+
+        fmt = None
+        try:
+            with NamedTemporaryFile("w", suffix=".tex", dir=TEX_OUTPUTDIR) as tex_tmp:
+                tex_tmp.write(preamble + "\\begin{document}\n\\end{document}\n")
+                tex_tmp.flush()
+                cmd = [
+                    "latex",
+                    "-ini",
+                    "-interaction=nonstopmode",
+                    "&latex",
+                    "mylatex.ltx",
+                    tex_tmp.name,
+                ]
+                ini = Popen(
+                    cmd,
+                    stdin=DEVNULL,
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    cwd=TEX_OUTPUTDIR,
+                )
+                ini.communicate()
+                produced = os.path.join(TEX_OUTPUTDIR, "mylatex.fmt")
+                if os.path.exists(produced):
+                    name = "n2t-fmt-%d-%d" % (os.getpid(), len(_format_cache))
+                    os.replace(produced, os.path.join(TEX_OUTPUTDIR, name + ".fmt"))
+                    fmt = name
+        except (IOError, OSError):
+            fmt = None
+
+        _format_cache[preamble] = fmt
+        return fmt
+
+
+def tex_compile(fn, fmt=None):
+    """
+    Invokes tex to compile the file with the given name, optionally
+    with a precompiled format (see _preamble_format).
     Returns the name of the output file (.dvi), the empty string if
     the name could not be determined, or None if compilation fails.
     """
 
-    from subprocess import PIPE, Popen
+    from subprocess import DEVNULL, PIPE, Popen
 
-    cmd = TEX_COMMAND + " " + "-output-directory=" + TEX_OUTPUTDIR + " " + fn
+    cmd = list(TEX_COMMAND)
+    if fmt is not None:
+        cmd.append("-fmt=" + fmt)
+    cmd.append("-output-directory=" + TEX_OUTPUTDIR)
+    cmd.append(fn)
 
     try:
-        # TODO: avoid shell with Popen
-        tex = Popen(cmd, shell=True, stdin=None, stdout=PIPE, stderr=PIPE)
-        tex.wait()
+        # run latex directly (no intermediate shell fork/parse); from
+        # the output directory so a dumped format file there is found
+        # by name. communicate() waits for the process itself.
+        tex = Popen(cmd, stdin=DEVNULL, stdout=PIPE, stderr=PIPE, cwd=TEX_OUTPUTDIR)
         tex_out, tex_err = tex.communicate()
 
         # check tex output to determine output file name or to see
         # if an error message indicating nothing was output is
-        # included.
-        dvifn, no_output = "", False
-        for ll in tex_out.decode("utf-8").split("\n"):
-            m = re.match(r"Output written on (\S+)", ll)
+        # included. The log is scanned as bytes; only the short
+        # fragments actually used get decoded, instead of making a
+        # full unicode copy of the log per compilation.
+        dvifn = ""
+        idx = tex_out.rfind(b"Output written on ")
+        if idx >= 0:
+            end = tex_out.find(b"\n", idx)
+            if end < 0:
+                end = len(tex_out)
+            line = tex_out[idx:end].decode("utf-8", errors="replace")
+            m = outputwritten_re.match(line)
             if m:
                 dvifn = m.group(1)
-            if "No pages of output" in ll:
-                no_output = True
+        no_output = b"No pages of output" in tex_out
 
         if no_output and not dvifn:
             # print >> sys.stderr, "rewritetex: failed to compile tex"
             error_lines = [
-                ll for ll in tex_out.decode("utf-8").split("\n") if "Error" in ll
+                ll.decode("utf-8", errors="replace")
+                for ll in tex_out.splitlines()
+                if b"Error" in ll
             ]
             if error_lines:
                 sys.stderr.write("\n".join(error_lines))
@@ -279,14 +556,12 @@ def run_catdvi(fn):
     Returns catdvi output or None if the invocation fails.
     """
 
-    from subprocess import PIPE, Popen
+    from subprocess import DEVNULL, PIPE, Popen
 
-    cmd = CATDVI_COMMAND + " " + fn
+    cmd = CATDVI_COMMAND + [fn]
 
     try:
-        # TODO: avoid shell with Popen
-        catdvi = Popen(cmd, shell=True, stdin=None, stdout=PIPE, stderr=PIPE)
-        catdvi.wait()
+        catdvi = Popen(cmd, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
         catdvi_out, catdvi_err = catdvi.communicate()
         return catdvi_out
     except IOError as e:
@@ -294,19 +569,13 @@ def run_catdvi(fn):
         return None
 
 
-def tex2str(tex):
+def _pmc_tex_tweaks(tex):
     """
-    Given a tex document as a string, returns a text string
-    approximating the tex content. Performs conversion using the
-    external tools tex and catdvi.
+    Applies minor tweaks to the given tex document to get around
+    compilation problems that frequently arise with PMC NXML embedded
+    tex.
     """
 
-    from tempfile import NamedTemporaryFile
-
-    # perform some minor tweaks to the given tex document to get
-    # around compilation problems that frequently arise with PMC
-    # NXML embedded tex:
-
     # remove "\usepackage{pmc}". It's not clear what the contents
     # of this package are (I have not been able to find it), but
     # compilation more often succeeds without it than with it.
@@ -315,9 +584,21 @@ def tex2str(tex):
     # replace "\documentclass{minimal}" with "\documentclass{slides}".
     # It's not clear why, but some font commands (e.g. "\tt") appear
     # to fail with the former.
-    tex = re.sub(r"(\\documentclass(?:\[[^\[\]]*\])?\{)minimal(\})", r"\1slides\2", tex)
+    tex = texminimal_re.sub(r"\1slides\2", tex)
+
+    return tex
+
 
-    # now ready to try conversion.
+def _convert_tex_source(tex, fmt=None):
+    """
+    Compiles the given tex document and returns the decoded catdvi
+    output for it, without whitespace cleanup, or None if conversion
+    fails. A precompiled format, when given, is tried first and
+    dropped on failure so a stale or incompatible dump can't lose a
+    conversion that plain compilation would have managed.
+    """
+
+    from tempfile import NamedTemporaryFile
 
     # create a temporary file for the tex content
     try:
@@ -325,7 +606,10 @@ def tex2str(tex):
             tex_tmp.write(tex)
             tex_tmp.flush()
 
-            tex_out_fn = tex_compile(tex_tmp.name)
+            tex_out_fn = tex_compile(tex_tmp.name, fmt)
+
+            if tex_out_fn is None and fmt is not None:
+                tex_out_fn = tex_compile(tex_tmp.name)
 
             if tex_out_fn is None:
                 # failed to compile
@@ -358,17 +642,168 @@ def tex2str(tex):
                 )
                 return None
 
-            # perform minor whitespace cleanup
-            dvistr = re.sub(r"\s+", " ", dvistr)
-            dvistr = re.sub(r"^\s+", "", dvistr)
-            dvistr = re.sub(r"\s+$", "", dvistr)
-
             return dvistr
     except IOError:
         sys.stderr.write("rewritetex: failed to create temporary file\n")
         raise
 
 
+def _clean_dvistr(dvistr):
+    """Performs minor whitespace cleanup on catdvi output: internal
+    runs collapse to single spaces and initial/terminal space goes."""
+    return " ".join(dvistr.split())
+
+
+def try_fast_tex2str(tex):
+    """
+    Converts a trivial formula (single letter, greek-letter command,
+    simple sub-/superscript) without invoking latex and catdvi, which
+    cost two process launches per conversion. Returns None when the
+    content is not recognizably trivial, leaving it to the full
+    pipeline.
+    """
+
+    m = texbody_re.search(tex)
+    body = (m.group(1) if m is not None else tex).strip()
+
+    m = fasttex_re.match(body)
+    if m is None:
+        return None
+    if m.group("letter") is not None:
+        return m.group("letter")
+    if m.group("greek") is not None:
+        # unknown commands fall through to the full pipeline
+        return GREEK.get(m.group("greek"))
+    # catdvi -s prints sub- and superscripts inline
+    return m.group("base") + m.group("script")
+
+
+def tex2str(tex):
+    """
+    Given a tex document as a string, returns a text string
+    approximating the tex content. Performs conversion using the
+    external tools tex and catdvi.
+    """
+
+    s = try_fast_tex2str(tex)
+    if s is not None:
+        return s
+
+    tex = _pmc_tex_tweaks(tex)
+
+    m = texbody_re.search(tex)
+    fmt = _preamble_format(tex[: m.start()]) if m is not None else None
+
+    dvistr = _convert_tex_source(tex, fmt)
+    if dvistr is None:
+        return None
+
+    return _clean_dvistr(dvistr)
+
+
+def tex2str_batch(tex_list):
+    """
+    Given a list of tex documents as strings, returns a parallel list
+    of text strings approximating their content, with None for failed
+    conversions. Documents sharing a preamble are compiled in a single
+    tex invocation with their bodies on separate sentinel-marked
+    pages, amortizing the dominant per-invocation tex and catdvi
+    startup cost; anything that cannot be batched that way falls back
+    to an individual tex2str call.
+    """
+
+    results = [None] * len(tex_list)
+    groups = {}
+    singles = []
+
+    for i, tex in enumerate(tex_list):
+        s = try_fast_tex2str(tex)
+        if s is not None:
+            results[i] = s
+            continue
+        tweaked = _pmc_tex_tweaks(tex)
+        m = texbody_re.search(tweaked)
+        if m is None:
+            # no recognizable document body to splice into a batch
+            singles.append(i)
+        else:
+            groups.setdefault(tweaked[: m.start()], []).append((i, m.group(1)))
+
+    def convert_group(group):
+        """Compiles one preamble group; returns converted results by
+        input index plus the indexes needing an individual retry."""
+        preamble, items = group
+        out = {}
+        retry = []
+
+        bodies = []
+        for j, (i, body) in enumerate(items):
+            bodies.append(
+                "\n\\newpage\n\\verb|%s|\n\n%s\n" % (BATCH_SEPARATOR % j, body)
+            )
+        source = (
+            preamble
+            + "\\begin{document}\n"
+            + "".join(bodies)
+            + "\\end{document}\n"
+        )
+
+        dvistr = _convert_tex_source(source, _preamble_format(preamble))
+        if dvistr is None:
+            # batch compilation failed; retry the items one by one so
+            # a single broken formula can't sink the whole group
+            retry.extend(i for i, _ in items)
+            return out, retry
+
+        pieces = batchsep_re.split(dvistr)
+        converted = {}
+        for k in range(1, len(pieces) - 1, 2):
+            converted[int(pieces[k])] = pieces[k + 1]
+
+        for j, (i, _) in enumerate(items):
+            piece = converted.get(j)
+            if piece is None:
+                # sentinel missing from the output; retry individually
+                retry.append(i)
+            else:
+                out[i] = _clean_dvistr(piece)
+
+        return out, retry
+
+    group_work = []
+    for preamble, items in groups.items():
+        if len(items) == 1:
+            singles.append(items[0][0])
+        else:
+            group_work.append((preamble, items))
+
+    # each conversion spends nearly all its time blocked in
+    # communicate() on latex/catdvi (which releases the GIL), so
+    # independent compilations overlap on a small thread pool
+    for out, retry in _map_maybe_parallel(convert_group, group_work):
+        for i, s in out.items():
+            results[i] = s
+        singles.extend(retry)
+
+    for i, s in zip(
+        singles, _map_maybe_parallel(lambda i: tex2str(tex_list[i]), singles)
+    ):
+        results[i] = s
+
+    return results
+
+
+def _map_maybe_parallel(func, work, max_workers=4):
+    """Maps func over work on a small thread pool, in order, falling
+    back to a plain map when there's nothing to overlap."""
+    if len(work) <= 1:
+        return [func(w) for w in work]
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        return list(ex.map(func, work))
+
+
 def rewrite_tex_element(e, s):
     """
     Given an XML tree element e and a string s, stores the original
@@ -377,15 +812,19 @@ def rewrite_tex_element(e, s):
     """
 
     # check that the attributes that will be used don't clobber
-    # anything
-    for a in (ORIG_TAG_ATTRIBUTE, ORIG_TEXT_ATTRIBUTE):
-        assert a not in e.attrib, (
-            "rewritetex: error: attribute '%s' already defined!" % a
-        )
+    # anything; take the attrib proxy once, as each e.attrib access
+    # builds a transient view object
+    attrib = e.attrib
+    assert (
+        ORIG_TAG_ATTRIBUTE not in attrib and ORIG_TEXT_ATTRIBUTE not in attrib
+    ), "rewritetex: error: attribute '%s' or '%s' already defined!" % (
+        ORIG_TAG_ATTRIBUTE,
+        ORIG_TEXT_ATTRIBUTE,
+    )
 
     # store original text content and tag as attributes
-    e.attrib[ORIG_TEXT_ATTRIBUTE] = e.text
-    e.attrib[ORIG_TAG_ATTRIBUTE] = e.tag
+    attrib[ORIG_TEXT_ATTRIBUTE] = e.text
+    attrib[ORIG_TAG_ATTRIBUTE] = e.tag
 
     # swap in the new ones
     e.text = s
@@ -412,6 +851,13 @@ class Stats(object):
             and self.conversions_err == 0
         )
 
+    def update(self, other):
+        self.rewrites += other.rewrites
+        self.cache_hits += other.cache_hits
+        self.cache_misses += other.cache_misses
+        self.conversions_ok += other.conversions_ok
+        self.conversions_err += other.conversions_err
+
     def __str__(self):
         return "%d rewrites (%d cache hits, %d misses; converted %d, failed %d)" % (
             self.rewrites,
@@ -422,46 +868,69 @@ class Stats(object):
         )
 
 
-def process_tree(tree, cache=None, stats=None, options=None):
-    if cache is None:
+def _rewrite_tex_elements(elements, cache=None, stats=None):
+    own_cache = cache is None
+    if own_cache:
         cache = get_cache()
     if stats is None:
         stats = Stats()
 
-    root = tree.getroot()
-
-    # find "tex-math" elements in any namespace ("local-name")
-    # anywhere in the tree.
-    for e in root.xpath("//*[local-name()='tex-math']"):
+    # Pass 1: resolve every "tex-math" element against the cache,
+    # queueing the misses so they can all be converted together
+    # instead of one tex invocation each.
+    pending = {}
+    for e in elements:
         tex = e.text
 
-        # normalize the tex document for cache lookup
-        tex_norm = normalize_tex(tex)
+        # normalize the tex document and digest it once for all the
+        # cache lookups and writes below
+        key = cache_key(normalize_tex(tex))
 
-        mapped = cache.get(tex_norm)
+        mapped = cache.get(key)
 
         if mapped is not None:
             stats.cache_hits += 1
+            # replace the <tex-math> element with the mapped text
+            rewrite_tex_element(e, mapped)
+            stats.rewrites += 1
+        elif key in pending:
+            # a conversion of this form is already queued; in the old
+            # per-element loop this occurrence would have hit the
+            # cache entry written by the first one
+            stats.cache_hits += 1
+            pending[key][0].append(e)
         else:
             stats.cache_misses += 1
+            pending[key] = ([e], tex)
 
-            # no existing mapping to string; try to convert
-            s = tex2str(tex)
+    # Pass 2: convert the misses in as few tex invocations as
+    # possible and rewrite the elements that queued them.
+    if pending:
+        keys = list(pending)
+        converted = tex2str_batch([pending[k][1] for k in keys])
 
+        for key, s in zip(keys, converted):
             # only use results of successful conversions
             if s is None or s == "":
-                mapped = None
                 stats.conversions_err += 1
-            else:
-                stats.conversions_ok += 1
-                mapped = s
-                cache.set(tex_norm, s)
+                continue
+            stats.conversions_ok += 1
+            cache.set(key, s)
+            for e in pending[key][0]:
+                rewrite_tex_element(e, s)
+                stats.rewrites += 1
+
+    # a cache created here has no owner that will save() it later, so
+    # flush the final partial write batch before it is dropped
+    if own_cache and hasattr(cache, "flush"):
+        cache.flush()
 
-        if mapped is not None:
-            # replace the <tex-math> element with the mapped text
-            rewrite_tex_element(e, mapped)
-            stats.rewrites += 1
 
+def process_tree(tree, cache=None, stats=None, options=None):
+    # iter with a wildcard-namespace tag is a plain C tree walk,
+    # unlike the local-name() XPath it replaces, which ran the XPath
+    # interpreter on every element in the document
+    _rewrite_tex_elements(tree.getroot().iter("{*}tex-math"), cache, stats)
     return tree
 
 
@@ -474,8 +943,11 @@ def read_tree(filename):
 
 
 def write_tree(tree, fn, options=None):
+    # lxml serializes to bytes; hand it the byte stream / file name
+    # directly so its C writer streams straight to the descriptor
+    # instead of going through a text-mode Python file object
     if options is not None and options.stdout:
-        tree.write(sys.stdout, encoding=OUTPUT_ENCODING)
+        tree.write(sys.stdout.buffer, encoding=OUTPUT_ENCODING)
         return True
 
     if options is not None and options.directory is not None:
@@ -491,8 +963,7 @@ def write_tree(tree, fn, options=None):
     # else:
     # OK to write output_fn
     try:
-        with open(output_fn, "w") as of:
-            tree.write(of, encoding=OUTPUT_ENCODING)
+        tree.write(output_fn, encoding=OUTPUT_ENCODING)
     except IOError as ex:
         sys.stderr.write("rewritetex: failed write: %s\n" % ex)
 
@@ -500,9 +971,59 @@ def write_tree(tree, fn, options=None):
 
 
 def process(fn, cache=None, stats=None, options=None):
-    tree = read_tree(fn)
-    process_tree(tree)
-    write_tree(tree, fn, options)
+    # iterparse builds the same tree as ET.parse but hands each
+    # "tex-math" element over as the parser closes it, so the elements
+    # are picked up during the single C parse pass instead of by a
+    # second walk over the finished tree. The whole tree is still
+    # needed (it gets written back out rewritten), so the elements are
+    # deliberately not clear()ed.
+    try:
+        context = ET.iterparse(fn, events=("end",), tag="{*}tex-math", huge_tree=True)
+        elements = [e for _, e in context]
+    except ET.XMLSyntaxError:
+        sys.stderr.write("Error parsing %s\n" % fn)
+        raise
+    _rewrite_tex_elements(elements, cache, stats)
+    write_tree(context.root.getroottree(), fn, options)
+
+
+class _WorkerCache(Cache):
+    """
+    Cache used by per-file worker processes: reads fall through to the
+    worker's own connection to the shared on-disk cache, while writes
+    are collected in memory so the parent can merge them after the
+    workers finish instead of having every worker contend for the
+    database write lock.
+    """
+
+    def __init__(self):
+        super(_WorkerCache, self).__init__(None)
+        try:
+            self._base = SqliteCache.load()
+        except Exception:
+            self._base = None
+
+    def get(self, key):
+        if key in self._map:
+            return self._map[key]
+        if self._base is not None:
+            return self._base.get(key)
+        return None
+
+    def new_entries(self):
+        return self._map
+
+
+def _process_file(args):
+    """
+    Processes one input file in a worker process; returns the worker's
+    Stats and its dict of new cache entries for the parent to merge.
+    """
+    fn, options = args
+    stats = Stats()
+    cache = _WorkerCache()
+    process(fn, cache, stats, options)
+    return stats, cache.new_entries()
 
 
 def argparser():
@@ -527,6 +1048,14 @@ def argparser():
     ap.add_argument(
         "-v", "--verbose", default=False, action="store_true", help="verbose output"
     )
+    ap.add_argument(
+        "-j",
+        "--jobs",
+        default=os.cpu_count() or 1,
+        type=int,
+        metavar="N",
+        help="number of files to process in parallel",
+    )
     ap.add_argument("file", nargs="+", help="input PubMed Central NXML file")
     return ap
 
@@ -536,8 +1065,25 @@ def main(argv):
     stats = Stats()
     cache = get_cache()
 
-    for fn in options.file:
-        process(fn, cache, stats, options)
+    # files are independent of each other, so with file output they
+    # can be farmed out to worker processes, merging stats and new
+    # cache entries here; with -s the workers would interleave their
+    # trees on the shared stdout, so that stays sequential
+    if len(options.file) > 1 and options.jobs > 1 and not options.stdout:
+        from multiprocessing import Pool
+
+        with Pool(min(options.jobs, len(options.file))) as pool:
+            work = [(fn, options) for fn in options.file]
+            for file_stats, new_entries in pool.imap_unordered(_process_file, work):
+                stats.update(file_stats)
+                if hasattr(cache, "bulk_set"):
+                    cache.bulk_set(new_entries.items())
+                else:
+                    for key, value in new_entries.items():
+                        cache.set(key, value)
+    else:
+        for fn in options.file:
+            process(fn, cache, stats, options)
 
     cache.save()
 
@@ -23,6 +23,21 @@ from lxml import etree as ET
 
 MAPPING_FILE_NAME = os.path.join(os.path.dirname(__file__), "data/entities.dat")
 
+
+def default_mapping_path():
+    """
+    Returns the path of the bundled unicode-to-ASCII mapping file,
+    resolving it as package data when nxml2txt is installed and
+    falling back to the source checkout layout when this module is
+    run as a plain script.
+    """
+    try:
+        from importlib.resources import files
+
+        return str(files("nxml2txt").joinpath("data/entities.dat"))
+    except Exception:
+        return MAPPING_FILE_NAME
+
 # XML tag to use to mark text content rewritten by this script.
 REWRITTEN_TAG = "n2t-u2a"
 
@@ -293,7 +308,9 @@ def argparser():
     return ap
 
 
-def load_mapping(mapfn=MAPPING_FILE_NAME):
+def load_mapping(mapfn=None):
+    if mapfn is None:
+        mapfn = default_mapping_path()
     if not os.path.exists(mapfn):
         # fall back to trying in script dir
         mapfn = os.path.join(
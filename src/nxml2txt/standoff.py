@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import sys
-import re
 import argparse
 import six
 import xml.etree.ElementTree as ET
@@ -55,11 +54,9 @@ class Standoff:
 
     def tag(self):
         # remove namespace spec from output, if any
-        if self.element.tag[0] == "{":
-            tag = re.sub(r"\{.*?\}", "", self.element.tag)
-        else:
-            tag = self.element.tag
-        return tag
+        # (rpartition is much cheaper than a regex for the fixed
+        # "{namespace}localname" form)
+        return self.element.tag.rpartition("}")[2]
 
     def set_prefix(self, prefix):
         self.prefix = prefix
@@ -76,11 +73,7 @@ class Standoff:
         # remove namespace specs from attribute names, if any
         attrib = {}
         for a in self.element.attrib:
-            if a[0] == "{":
-                an = re.sub(r"\{.*?\}", "", a)
-            else:
-                an = a
-            attrib[an] = self.element.attrib[a]
+            attrib[a.rpartition("}")[2]] = self.element.attrib[a]
 
         return "%s%d\t%s %d %d\t%s\t%s" % (
             self.prefix,